@@ -1,12 +1,76 @@
-from typing import List, Dict
-import requests as req
+from typing import Any, Coroutine, List, Dict, FrozenSet, Iterable, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
+from urllib.request import urlopen
 import logging as log
 import pandas as pd
-import json
+import numpy as np
+import aiohttp
+import asyncio
+import orjson
+import shutil
+import math
+import csv
 import os
 
 
+# Herbario Digital's public API settings
+MAX_CONCURRENT_REQUESTS = 32
+REQUEST_TIMEOUT = 10  # seconds
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.5  # seconds, doubled on every retry
+RETRY_STATUSES = (502, 503, 504)
+GONE_STATUSES = (404, 410)  # a specie answering these was removed upstream
+PAGE_PROBE_WINDOW = 16  # pages requested at once when the total count is unknown
+
+# Set by `prepare()` once the Rasgos-CL database has been downloaded
+_DB_READY = False
+
+# Every specie's response is cached here, one file per id.
+# Species removed upstream get an empty `{id}.gone` marker instead
+SPECIES_CACHE_DIR = os.path.join("data", "temp", "species")
+
+# Conservation states sorted from least to most threatened
+CONSERVATION_STATES = [
+    "Not Evaluated (NE)",
+    "Data Deficient (DD)",
+    "Least Concern (LC)",
+    "Conservation Dependent (CD)",
+    "Near Threatened (NT)",
+    "Almost Threatened (NT)",
+    "Vulnerable (VU)",
+    "Endangered (EN)",
+    "Critically Endangered (CR)",
+    "Extinct in the Wild (EW)",
+    "Extinct (EX)",
+]
+CONSERVATION_RANK = {state: rank for rank, state in enumerate(CONSERVATION_STATES)}
+
+# Herbario Digital's region names mapped to their common names
+REGIONS = {
+    "Araucania Region": "Araucanía",
+    "Maule Region": "Maule",
+    "Atacama Region": "Atacama",
+    "Antofagasta Region": "Antofagasta",
+    "Juan Fernández Archipelago": "Juan Fernández",
+    "Tarapaca Region": "Tarapacá",
+    "Santiago Metropolitan Region": "Metropolitana",
+    "Liberator General Bernardo O'Higgins Region": "Libertador Bernardo O'Higgins",
+    "Arica and Parinacota Region": "Arica y Parinacota",
+    "River Region": "Los Ríos",
+    "Ñuble Region": "Ñuble",
+    "Coquimbo Region": "Coquimbo",
+    "Los Lagos Region": "Los Lagos",
+    "Magallanes and Chilean Antarctic Region": "Magallanes",
+    "Bio Bio Region": "Bío-Bío",
+    "Valparaiso Region": "Valparaíso",
+    "Region of Aysén del General Carlos Ibáñez del Campo": "Aysén",
+}
+
+# Species per worker below which spawning processes costs more than it saves
+SIMPLIFY_CHUNK_SIZE = 5000
+
+
 def prepare():
     """
     Prepares environment to download all of the needed data from Herbario Digital's public API.
@@ -19,7 +83,7 @@ def prepare():
     """
 
     # Directories creation
-    dirs = ["data", os.path.join("data", "temp"), "errors"]
+    dirs = ["data", os.path.join("data", "temp"), SPECIES_CACHE_DIR, "errors"]
     for dir in dirs:
         if not os.path.exists(dir):
             os.mkdir(dir)
@@ -38,13 +102,21 @@ def prepare():
 
     # Pre-requisite data download
     traits_url = "https://raw.githubusercontent.com/dylancraven/Rasgos-CL/main/Data/RasgosCL_spp_names_clean.csv"
+    global _DB_READY
+    filepath = os.path.join("data", "species_names.csv")
     try:
-        traits_df = pd.read_csv(traits_url)
-        filepath = os.path.join("data", "species_names.csv")
-        traits_df.to_csv(filepath)
+        # Stored as downloaded, it is only parsed when the accepted names are needed.
+        # A failed download must not leave a truncated database behind, so write it aside first
+        with urlopen(traits_url, timeout=REQUEST_TIMEOUT) as res:
+            with open(f"{filepath}.part", "wb") as file:
+                shutil.copyfileobj(res, file)
+        os.replace(f"{filepath}.part", filepath)
+        _DB_READY = True
     except Exception as err:
         print(f"Error when downloading Rasgos-CL species data: {err}")
         log.error(err)
+        if os.path.exists(f"{filepath}.part"):
+            os.remove(f"{filepath}.part")
 
 
 def save_temp(filename: str, data: any):
@@ -55,8 +127,10 @@ def save_temp(filename: str, data: any):
     """
     filepath = os.path.join("data", "temp", filename)
     try:
-        with open(filepath, "w") as file:
-            json.dump(data, file)
+        # Encode everything up front so the file is written in a single call
+        payload = orjson.dumps(data)
+        with open(filepath, "wb", buffering=1024 * 1024) as file:
+            file.write(payload)
     except ValueError as value_error:
         print(f"Value error when saving data into {filename}")
         log.error(value_error)
@@ -71,92 +145,332 @@ def clean_empty_logs():
     """
     Deletes empty log files.
     """
-    logs = os.listdir("errors")
-    for log in logs:
-        filepath = os.path.join("errors", log)
-        with open(filepath, "r") as logfile:
-            if not len(logfile.readlines()):
-                os.remove(filepath)
+    with os.scandir("errors") as logs:
+        for logfile in logs:
+            # A single stat tells whether the file is empty, no need to read it
+            if logfile.is_file() and logfile.stat().st_size == 0:
+                os.remove(logfile.path)
+
+
+async def fetch_one(
+    session: aiohttp.ClientSession,
+    semaphore: asyncio.Semaphore,
+    url: str,
+    expected_statuses: Tuple[int, ...] = (),
+) -> Tuple[Optional[int], Optional[bytes]]:
+    """
+    Retrieves the raw response body from `url` using a shared `session`.
+    At most `MAX_CONCURRENT_REQUESTS` calls are in flight at once, as bounded by `semaphore`.
+    Connection errors and gateway errors are retried up to `MAX_RETRIES` times with exponential backoff.
+    Non-ok statuses listed in `expected_statuses` are not reported as errors.
 
+    Returns a tuple `(status, content)`. content is None unless the response was ok,
+    and status is None when no response was received at all.
+    """
+    async with semaphore:
+        for attempt in range(MAX_RETRIES + 1):
+            if attempt:
+                await asyncio.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
+            retry = attempt < MAX_RETRIES
+
+            try:
+                async with session.get(url) as res:
+                    if res.status in RETRY_STATUSES and retry:
+                        continue
+
+                    if res.status in expected_statuses:
+                        return res.status, None
+
+                    if res.status != 200:
+                        msg = f"Non-ok status code at {url}: [{res.status}] {res.reason}"
+                        print(msg)
+                        log.error(msg)
+                        return res.status, None
+
+                    return res.status, await res.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as conn_err:
+                if retry:
+                    continue
+                # Timeouts have an empty message, so also show the url and the error type
+                msg = f"Error when accessing the API at {url}: {conn_err!r}"
+                print(msg)
+                log.error(msg)
+                return None, None
+
+
+def decode_json(content: Optional[bytes], source: str) -> Optional[Dict]:
+    """
+    Decodes json `content` obtained from `source`.
+
+    Returns the decoded json data, or None if there is no content or it is not valid json.
+    """
+    if content is None:
+        return None
+    try:
+        return orjson.loads(content)
+    except orjson.JSONDecodeError as decode_error:
+        print(f"Error when decoding json at {source}")
+        log.error(decode_error)
+        return None
+
+
+async def fetch_json(
+    session: aiohttp.ClientSession,
+    semaphore: asyncio.Semaphore,
+    url: str,
+    expected_statuses: Tuple[int, ...] = (),
+) -> Tuple[Optional[int], Optional[Dict]]:
+    """
+    Retrieves and decodes json data from `url`.
+
+    Returns a tuple `(status, json_data)`, as `fetch_one()` does.
+    json_data is None if the request failed or the response is not valid json.
+    """
+    status, content = await fetch_one(session, semaphore, url, expected_statuses)
+    return status, decode_json(content, url)
+
+
+async def fetch_specie(
+    session: aiohttp.ClientSession, semaphore: asyncio.Semaphore, id: int
+) -> Tuple[int, Optional[int], Optional[bytes]]:
+    """
+    Retrieves a specie's raw json data.
+    It is not decoded here, that only happens once, when it is read back from the species cache.
 
-def get_all(start_at=1) -> List[Dict]:
+    Returns a tuple `(id, status, content)`, where content is None if the request failed.
+    """
+    url = f"https://api.herbariodigital.cl/species/{id}/?format=json&lang=en"
+    status, content = await fetch_one(
+        session, semaphore, url, expected_statuses=GONE_STATUSES
+    )
+    return id, status, content
+
+
+def specie_cache_path(id: int) -> str:
+    """
+    Returns the location of a specie's cached json data.
+    """
+    return os.path.join(SPECIES_CACHE_DIR, f"{id}.json")
+
+
+def specie_gone_path(id: int) -> str:
+    """
+    Returns the location of the marker left for a specie that is no longer available at the API.
+    """
+    return os.path.join(SPECIES_CACHE_DIR, f"{id}.gone")
+
+
+def is_specie_gone(id: int) -> bool:
+    """
+    Tells whether a previous run found that the specie is no longer available at the API.
+    """
+    return os.path.exists(specie_gone_path(id))
+
+
+def cache_specie(id: int, content: bytes):
+    """
+    Saves a specie's raw json data into the species cache, as received.
+    """
+    path = specie_cache_path(id)
+    # Write to a temporary file first so that an interruption never leaves a partial cache entry
+    with open(f"{path}.part", "wb") as file:
+        file.write(content)
+    os.replace(f"{path}.part", path)
+
+
+def load_cached_specie(id: int) -> Optional[Dict]:
+    """
+    Reads a specie's cached data.
+    An entry that is not valid json is removed, so it is requested again on the next run.
+
+    Returns the decoded json data, or None if the specie is not cached.
+    """
+    path = specie_cache_path(id)
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as file:
+        json_data = decode_json(file.read(), path)
+    if json_data is None:
+        os.remove(path)
+    return json_data
+
+
+def _run(coro: Coroutine) -> Any:
+    """
+    Runs `coro` to completion and returns its result.
+    When an event loop is already running (e.g. inside Jupyter), the coroutine runs on its own loop in a worker thread.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+
+def client_session() -> aiohttp.ClientSession:
+    """
+    Creates a session whose connection pool is shared by every request to Herbario Digital's public API.
+    Connections are kept alive between requests, so the TLS handshake is paid once per pooled socket.
+    Must be called from within a running event loop.
+    """
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=MAX_CONCURRENT_REQUESTS,
+            limit_per_host=MAX_CONCURRENT_REQUESTS,
+            keepalive_timeout=30,
+        ),
+        timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT),
+    )
+
+
+def get_all(
+    start_at=1, name_set: Optional[FrozenSet[str]] = None
+) -> Optional[List[Dict]]:
     """
     Retrieves every specie's scientific_name and id available at Herbario Digital's public API.
+    If `name_set` is given, only species whose scientific_name is in it are kept.
+
+    Returns None if any page could not be retrieved, so an incomplete list is never taken for the full one.
     """
     print("Retrieving species list")
-    base_url = "https://api.herbariodigital.cl/species_list/?format=json"
-    page = start_at - 1
+    return _run(_get_all(start_at, name_set))
 
-    species_list = list()
 
-    has_data = True
-    while has_data:
-        results = list()
-        page += 1
-        url = f"{base_url}&page={page}"
-
-        print(f"Retrieving page {page}...")
-        try:
-            res = req.get(url)
-        except req.ConnectionError as conn_err:
-            print(f"Error when accessing the API: {conn_err}")
-            log.error(conn_err)
-            break
-
-        if res.status_code != 200:
-            print(f"Non-ok status code at page {page}")
-            continue
-
-        try:
-            json_data = res.json()
-        except req.JSONDecodeError as decode_error:
-            print(f"Error when decoding json at page {page}")
-            log.error(decode_error)
-            break
+async def _get_all(
+    start_at: int, name_set: Optional[FrozenSet[str]]
+) -> Optional[List[Dict]]:
+    base_url = "https://api.herbariodigital.cl/species_list/?format=json"
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    failed_pages = list()
 
-        results = json_data.get("results")
-        if not results or not len(results):
+    async with client_session() as session:
+        print(f"Retrieving page {start_at}...")
+        status, first_page = await fetch_json(
+            session, semaphore, f"{base_url}&page={start_at}", expected_statuses=(404,)
+        )
+        if first_page is None and status != 404:
+            msg = f"Could not retrieve species list page {start_at}"
+            print(msg)
+            log.error(msg)
+            return None
+        if not first_page or not first_page.get("results"):
             print("No more data. Closing process.")
-            has_data = False
-            break
+            return list()
+
+        pages = [first_page]
+        count = first_page.get("count")
+        if count:
+            # Every page but the last one has as many results as the first one
+            page_size = len(first_page["results"])
+            last_page = math.ceil(count / page_size)
+            print(f"Retrieving pages {start_at + 1} to {last_page}...")
+            responses = await asyncio.gather(
+                *[
+                    fetch_json(session, semaphore, f"{base_url}&page={page}")
+                    for page in range(start_at + 1, last_page + 1)
+                ]
+            )
+            for page, (_, json_data) in zip(range(start_at + 1, last_page + 1), responses):
+                if json_data is None:
+                    failed_pages.append(page)
+                else:
+                    pages.append(json_data)
+        else:
+            # Without a total count, probe the following pages in concurrent windows until one comes back empty.
+            # Windows overshoot the last page, and pages past it answer 404, which just means there is no more data.
+            # Any other failed page is an error, but the pages after it are still retrieved
+            window_start = start_at + 1
+            has_data = True
+            while has_data:
+                window = range(window_start, window_start + PAGE_PROBE_WINDOW)
+                print(f"Retrieving pages {window.start} to {window.stop - 1}...")
+                window_pages = await asyncio.gather(
+                    *[
+                        fetch_json(
+                            session,
+                            semaphore,
+                            f"{base_url}&page={page}",
+                            expected_statuses=(404,),
+                        )
+                        for page in window
+                    ]
+                )
+                window_failures = 0
+                for page, (status, json_data) in zip(window, window_pages):
+                    if status == 404 or (json_data is not None and not json_data.get("results")):
+                        has_data = False
+                        break
+                    if json_data is None:
+                        failed_pages.append(page)
+                        window_failures += 1
+                        continue
+                    pages.append(json_data)
+
+                # A whole window failing means the API is unreachable, not that data keeps going
+                if window_failures == len(window):
+                    has_data = False
+                window_start = window.stop
+            print("No more data. Closing process.")
+
+    if failed_pages:
+        msg = f"Could not retrieve species list pages {failed_pages}"
+        print(msg)
+        log.error(msg)
+        return None
 
+    species_list = list()
+    for json_data in pages:
         species_list.extend(
             [
                 {
                     "id": specie.get("id"),
                     "scientific_name": specie.get("scientific_name"),
                 }
-                for specie in results
+                for specie in json_data.get("results") or []
+                if name_set is None or specie.get("scientific_name") in name_set
             ]
         )
 
     return species_list
 
 
-def get_accepted_names() -> List[str]:
+def get_accepted_names() -> FrozenSet[str]:
     """
-    Reads Rasgos-CL database and returns a list of accepted names.
+    Reads Rasgos-CL database and returns the set of accepted names.
     """
     print("Getting species' scientific names from Rasgos-CL")
     db_path = os.path.join("data", "species_names.csv")
-    if not os.path.exists:
+    if not _DB_READY and not os.path.exists(db_path):
         print("Database has not been downloaded! Remember to call `prepare()`")
-        return
-    df = pd.read_csv(db_path)
-    return df["accepted_full_name"].to_list()
+        return frozenset()
+    # Only one text column is needed, so a plain csv reader is enough
+    with open(db_path, newline="") as file:
+        reader = csv.reader(file)
+        header = next(reader, [])
+        if "accepted_full_name" not in header:
+            msg = f"No `accepted_full_name` column at {db_path}"
+            print(msg)
+            log.error(msg)
+            return frozenset()
+        idx = header.index("accepted_full_name")
+        return frozenset(row[idx] for row in reader if len(row) > idx and row[idx])
 
 
-def filter_species(herbario_species: List[Dict], name_list: List[str]) -> List[Dict]:
+def filter_species(herbario_species: List[Dict], name_list: Iterable[str]) -> List[Dict]:
     """
     Filters collected species depending if their scientific name is in the name_list.
 
     Returns a list of dictionaries `{ "herbario_id": int, "scientific_name": str }`.
     """
     print("Filtering species")
+    # `get_accepted_names()` already returns a set, only build one for other iterables
+    name_set = name_list if isinstance(name_list, (set, frozenset)) else frozenset(name_list)
     accepted_species = list()
     for specie in herbario_species:
         scientific_name = specie.get("scientific_name")
-        if scientific_name and scientific_name in name_list:
+        if scientific_name and scientific_name in name_set:
             accepted_species.append(
                 {
                     "id": specie.get("id"),
@@ -169,13 +483,12 @@ def filter_species(herbario_species: List[Dict], name_list: List[str]) -> List[D
 def get_accepted_species(herbario_species: List[Dict]) -> List[Dict]:
     """
     Retrieves specific species' data available at Herbario Digital's public API.
+    Every specie is cached at `data/temp/species/` as soon as it arrives, so an interrupted run resumes where it stopped.
     """
     print("Retrieving accepted species")
-    base_url = "https://api.herbariodigital.cl/species/"
 
-    species_list = list()
-
-    for idx, specie in enumerate(herbario_species):
+    ids = list()
+    for specie in herbario_species:
         id = specie.get("id")
         scientific_name = specie.get("scientific_name")
         if not id:
@@ -184,34 +497,71 @@ def get_accepted_species(herbario_species: List[Dict]) -> List[Dict]:
             log.error(msg)
             continue
 
-        url = f"{base_url}{id}/?format=json&lang=en"
-        print(f"Retrieving specie {idx+1} of {len(herbario_species)}")
-
-        try:
-            res = req.get(url)
-        except req.ConnectionError as conn_err:
-            print(f"error when accessing the API: {conn_err}")
-            log.error(conn_err)
-            break
+        ids.append(id)
 
-        if not res.ok:
-            msg = f"Non-ok status code at specie {id}: [{res.status_code}] {res.reason}"
-            print(msg)
-            log.error(msg)
-            continue
+    # Responses go straight to disk, then species are read back one at a time
+    _run(_fetch_species(ids))
+    species_list = list()
+    for id in ids:
+        json_data = load_cached_specie(id)
+        if json_data is not None:
+            species_list.append(json_data)
 
-        try:
-            json_data = res.json()
-        except req.JSONDecodeError as decode_error:
-            print(f"Error when decoding json at specie with id {id}")
-            log.error(decode_error)
-            break
+    gone = sum(1 for id in ids if is_specie_gone(id))
+    if gone:
+        print(f"{gone} species are no longer available at the API, skipping them")
 
-        species_list.append(json_data)
+    missing = len(ids) - len(species_list) - gone
+    if missing:
+        msg = f"{missing} species could not be retrieved, run the pipeline again to retry them"
+        print(msg)
+        log.error(msg)
 
     return species_list
 
 
+async def _fetch_species(ids: List[int]):
+    unique_ids = list(dict.fromkeys(ids))
+    pending = [
+        id
+        for id in unique_ids
+        if not os.path.exists(specie_cache_path(id)) and not is_specie_gone(id)
+    ]
+    print(f"{len(unique_ids) - len(pending)} species already cached or gone")
+
+    if not pending:
+        return
+
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    async with client_session() as session:
+        # Write every response as soon as it arrives instead of holding all of them in memory
+        requests = [fetch_specie(session, semaphore, id) for id in pending]
+        for done, request in enumerate(asyncio.as_completed(requests), start=1):
+            id, status, content = await request
+            print(f"Retrieved specie {done} of {len(pending)}")
+            if content is not None:
+                cache_specie(id, content)
+            elif status in GONE_STATUSES:
+                # Permanent, there is no point in requesting it again on later runs
+                msg = f"Specie {id} is no longer available: [{status}]"
+                print(msg)
+                log.error(msg)
+                open(specie_gone_path(id), "wb").close()
+
+
+def missing_species(herbario_species: List[Dict], herbario_species_accepted: List[Dict]) -> int:
+    """
+    Counts how many species with an `id` in herbario_species are missing from the retrieved herbario_species_accepted.
+    Species that are no longer available at the API are not expected.
+    """
+    expected = sum(
+        1
+        for specie in herbario_species
+        if specie.get("id") and not is_specie_gone(specie.get("id"))
+    )
+    return expected - len(herbario_species_accepted)
+
+
 def simplify_data(herbario_species: List[Dict]) -> pd.DataFrame:
     """
     Filters obtained data and transforms it into a simplified version ready to be used by pandas.
@@ -226,69 +576,102 @@ def simplify_data(herbario_species: List[Dict]) -> pd.DataFrame:
     pd.DataFrame
         a pd.DataFrame of simplified data for analysis.
     """
-    conservation_states = [
-        "Not Evaluated (NE)",
-        "Data Deficient (DD)",
-        "Least Concern (LC)",
-        "Conservation Dependent (CD)",
-        "Near Threatened (NT)",
-        "Almost Threatened (NT)",
-        "Vulnerable (VU)",
-        "Endangered (EN)",
-        "Critically Endangered (CR)",
-        "Extinct in the Wild (EW)",
-        "Extinct (EX)",
+    workers = min(
+        os.cpu_count() or 1, math.ceil(len(herbario_species) / SIMPLIFY_CHUNK_SIZE)
+    )
+    if workers <= 1:
+        return _simplify_chunk(herbario_species)
+
+    # Every specie is simplified independently, so chunks can be spread across CPU cores
+    chunk_size = math.ceil(len(herbario_species) / workers)
+    chunks = [
+        herbario_species[start : start + chunk_size]
+        for start in range(0, len(herbario_species), chunk_size)
     ]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        simplified = list(executor.map(_simplify_chunk, chunks))
 
-    regions = {
-        "Araucania Region": "Araucanía",
-        "Maule Region": "Maule",
-        "Atacama Region": "Atacama",
-        "Antofagasta Region": "Antofagasta",
-        "Juan Fernández Archipelago": "Juan Fernández",
-        "Tarapaca Region": "Tarapacá",
-        "Santiago Metropolitan Region": "Metropolitana",
-        "Liberator General Bernardo O'Higgins Region": "Libertador Bernardo O'Higgins",
-        "Arica and Parinacota Region": "Arica y Parinacota",
-        "River Region": "Los Ríos",
-        "Ñuble Region": "Ñuble",
-        "Coquimbo Region": "Coquimbo",
-        "Los Lagos Region": "Los Lagos",
-        "Magallanes and Chilean Antarctic Region": "Magallanes",
-        "Bio Bio Region": "Bío-Bío",
-        "Valparaiso Region": "Valparaíso",
-        "Region of Aysén del General Carlos Ibáñez del Campo": "Aysén",
-    }
-
-    simplified = []
+    return pd.concat(simplified, ignore_index=True)
+
+
+def _simplify_chunk(herbario_species: List[Dict]) -> pd.DataFrame:
+    # Build each column on its own so pandas does not have to infer types row by row
+    ids, names, habits, statuses, states = [], [], [], [], []
+    max_heights, min_heights = [], []
     for specie in herbario_species:
-        simplified_specie = {
-            "id": specie.get("id"),
-            "scientific_name": specie.get("scientific_name"),
-            "habit": specie.get("habit"),
-            "status": specie.get("status"),
-            "conservation_state": conservation_states[0],
-            "maximum_height": specie.get("maximum_height"),
-            "minimum_height": specie.get("minimum_height"),
-        }
+        ids.append(specie.get("id"))
+        names.append(specie.get("scientific_name"))
+        habits.append(specie.get("habit"))
+        statuses.append(specie.get("status"))
+        max_heights.append(specie.get("maximum_height"))
+        min_heights.append(specie.get("minimum_height"))
+
         pre_conservation_state = specie.get("conservation_state")
         if len(pre_conservation_state) >= 1:
-            simplified_specie["conservation_state"] = sorted(
-                pre_conservation_state,
-                key=lambda state: conservation_states.index(state),
-            )[0]
+            states.append(
+                min(pre_conservation_state, key=CONSERVATION_RANK.__getitem__)
+            )
+        else:
+            states.append(CONSERVATION_STATES[0])
+
+    simplified = pd.DataFrame(
+        {
+            "id": ids,
+            "scientific_name": names,
+            "habit": habits,
+            "status": statuses,
+            "conservation_state": states,
+            "maximum_height": max_heights,
+            "minimum_height": min_heights,
+        }
+    )
 
-        pre_regions = [region.get("name") for region in specie.get("region")]
-        for raw_region, common_region in regions.items():
+    # One-hot encode every specie's regions in a single pass
+    species_regions = pd.DataFrame(
+        [
+            (specie.get("id"), region.get("name"))
+            for specie in herbario_species
+            for region in specie.get("region")
+        ],
+        columns=["id", "region"],
+    )
+    species_regions["region"] = species_regions["region"].map(REGIONS)
+    onehot = pd.crosstab(species_regions["id"], species_regions["region"]).clip(upper=1)
+
+    # Region columns only hold 0 or 1
+    region_df = (
+        onehot.reindex(index=ids, columns=list(REGIONS.values()), fill_value=0)
+        .astype(np.int8)
+        .reset_index(drop=True)
+        .rename_axis(columns=None)
+    )
 
-            if raw_region in pre_regions:
-                simplified_specie[common_region] = 1
-            else:
-                simplified_specie[common_region] = 0
+    return pd.concat([simplified, region_df], axis=1)
+
+
+def save_final_files(
+    herbario_species_filtered: List[Dict],
+    herbario_species_accepted: List[Dict],
+    herbario_species: pd.DataFrame,
+    species_path: str,
+):
+    """
+    Saves the accepted species and their simplified version, which later runs reuse first.
+    Nothing is saved when no specie was retrieved or when some are still missing,
+    so the next run retries from `herbario_species_filtered.json`.
+    """
+    if not herbario_species_accepted:
+        msg = "No accepted species were retrieved, skipping final files"
+        print(msg)
+        log.error(msg)
+        return
 
-        simplified.append(simplified_specie)
+    if missing_species(herbario_species_filtered, herbario_species_accepted):
+        print("Skipping final files, so missing species are retried on the next run")
+        return
 
-    return pd.DataFrame(simplified)
+    save_temp("herbario_species_accepted.json", herbario_species_accepted)
+    herbario_species.to_parquet(species_path, engine="pyarrow")
 
 
 def pipeline(clean_logs=True, clean_temp=False) -> pd.DataFrame:
@@ -297,6 +680,7 @@ def pipeline(clean_logs=True, clean_temp=False) -> pd.DataFrame:
     Attempts to read already downloaded data from `data/temp/`.
     Falls back to latest available file until it find the latest step.
     If no file is found, attempts to download data directly from the API.
+    Final files are only saved once every filtered specie has been retrieved.
 
     Parameters
     ----------
@@ -304,7 +688,7 @@ def pipeline(clean_logs=True, clean_temp=False) -> pd.DataFrame:
         Deletes every empty log file at `errors/`.
         (default is True)
     clean_temp  :   bool, optional
-        Deletes every json file at `data/temp/`.
+        Deletes every json file at `data/temp/`, including the species cache.
         (default is False)
 
     Returns
@@ -323,55 +707,84 @@ def pipeline(clean_logs=True, clean_temp=False) -> pd.DataFrame:
     accepted_filename = "herbario_species_accepted.json"
     accepted_path = os.path.join("data", "temp", accepted_filename)
 
-    species_filename = "herbario_species.csv"
+    species_filename = "herbario_species.parquet"
     species_path = os.path.join("data", species_filename)
 
+    legacy_species_filename = "herbario_species.csv"
+    legacy_species_path = os.path.join("data", legacy_species_filename)
+
     # Get final json file
     if os.path.exists(species_path):
         print("Reusing last species file")
-        herbario_species = pd.read_csv(species_path)
+        herbario_species = pd.read_parquet(species_path, engine="pyarrow")
+
+    elif os.path.exists(legacy_species_path):
+        print("Reusing last species file, converting it to parquet")
+        herbario_species = pd.read_csv(legacy_species_path, index_col=0)
+        herbario_species.to_parquet(species_path, engine="pyarrow")
 
     elif os.path.exists(accepted_path):
         print("Reusing last accepted species file")
-        with open(accepted_path, "r") as file:
-            herbario_species_accepted = json.load(file)
+        with open(accepted_path, "rb") as file:
+            herbario_species_accepted = orjson.loads(file.read())
         herbario_species = simplify_data(herbario_species_accepted)
-        herbario_species.to_csv(species_path)
+        herbario_species.to_parquet(species_path, engine="pyarrow")
 
     elif os.path.exists(filtered_path):
         print("Reusing last filtered species file")
-        with open(filtered_path, "r") as file:
-            herbario_species_filtered = json.load(file)
+        with open(filtered_path, "rb") as file:
+            herbario_species_filtered = orjson.loads(file.read())
         herbario_species_accepted = get_accepted_species(herbario_species_filtered)
-        save_temp("herbario_species_accepted.json", herbario_species_accepted)
         herbario_species = simplify_data(herbario_species_accepted)
-        herbario_species.to_csv(species_path)
+        save_final_files(
+            herbario_species_filtered,
+            herbario_species_accepted,
+            herbario_species,
+            species_path,
+        )
 
     elif os.path.exists(all_path):
         print("Reusing last species list file")
-        with open(all_path, "r") as file:
-            herbario_species_all = json.load(file)
+        with open(all_path, "rb") as file:
+            herbario_species_all = orjson.loads(file.read())
 
         accepted_names = get_accepted_names()
+        if not accepted_names:
+            msg = "No accepted names available from Rasgos-CL, species cannot be filtered"
+            log.error(msg)
+            raise RuntimeError(msg)
         herbario_species_filtered = filter_species(herbario_species_all, accepted_names)
         save_temp("herbario_species_filtered.json", herbario_species_filtered)
         herbario_species_accepted = get_accepted_species(herbario_species_filtered)
-        save_temp("herbario_species_accepted.json", herbario_species_accepted)
         herbario_species = simplify_data(herbario_species_accepted)
-        herbario_species.to_csv(species_path)
+        save_final_files(
+            herbario_species_filtered,
+            herbario_species_accepted,
+            herbario_species,
+            species_path,
+        )
 
     else:
         print("No file to reuse, downloading from source")
-        herbario_species_all = get_all()
-        save_temp("herbario_species_all.json", herbario_species_all)
-
         accepted_names = get_accepted_names()
-        herbario_species_filtered = filter_species(herbario_species_all, accepted_names)
+        if not accepted_names:
+            msg = "No accepted names available from Rasgos-CL, species cannot be filtered"
+            log.error(msg)
+            raise RuntimeError(msg)
+        herbario_species_filtered = get_all(name_set=accepted_names)
+        if herbario_species_filtered is None:
+            raise RuntimeError(
+                "Species list is incomplete, run the pipeline again to retry the missing pages"
+            )
         save_temp("herbario_species_filtered.json", herbario_species_filtered)
         herbario_species_accepted = get_accepted_species(herbario_species_filtered)
-        save_temp("herbario_species_accepted.json", herbario_species_accepted)
         herbario_species = simplify_data(herbario_species_accepted)
-        herbario_species.to_csv(species_path)
+        save_final_files(
+            herbario_species_filtered,
+            herbario_species_accepted,
+            herbario_species,
+            species_path,
+        )
 
     if clean_logs:
         clean_empty_logs()
@@ -381,7 +794,10 @@ def pipeline(clean_logs=True, clean_temp=False) -> pd.DataFrame:
         temp_files = os.listdir(temp_dir)
         for file in temp_files:
             filepath = os.path.join(temp_dir, file)
-            os.remove(filepath)
+            if os.path.isdir(filepath):
+                shutil.rmtree(filepath)
+            else:
+                os.remove(filepath)
 
     return herbario_species
 